@@ -1,26 +1,29 @@
-from torch.nn import MultiheadAttention
-from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 from datetime import datetime
 import wandb
 from retriever import SimCSE_Retriever
 import argparse
+import hashlib
 import joblib
+import pickle
+import shutil
 from tqdm import tqdm
 import os
 from typing import List, Optional
 import torch
+import torch.nn.functional as F
 import pandas as pd
-from datasets import Dataset, DatasetDict
+from datasets import Dataset, DatasetDict, load_from_disk
 from transformers.activations import get_activation
 from torch import nn
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 from sklearn.preprocessing import LabelEncoder
 from transformers import (
+    DataCollatorWithPadding,
     Trainer,
     TrainingArguments,
     ElectraModel,
     ElectraPreTrainedModel,
-    ElectraTokenizer,
+    ElectraTokenizerFast,
 )
 from transformers.modeling_outputs import SequenceClassifierOutput
 
@@ -28,6 +31,9 @@ from transformers.modeling_outputs import SequenceClassifierOutput
 
 checkpoint_for_adapter = "howey/electra-base-mnli"
 
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
 bad_classes = [
     "prejudicial language",
     "fallacy of slippery slope",
@@ -43,150 +49,184 @@ class ElectraClassificationHead(nn.Module):
         classifier_dropout = config.classifier_dropout if config.classifier_dropout is not None \
             else config.hidden_dropout_prob
         self.dropout = nn.Dropout(classifier_dropout)
+        self.activation = get_activation("gelu")
         self.out_proj = nn.Linear(config.hidden_size, config.num_labels)
 
     def forward(self, features):
         x = features[:, 0, :]
         x = self.dropout(x)
         x = self.dense(x)
-        x = get_activation("gelu")(x)
+        x = self.activation(x)
         x = self.dropout(x)
         x = self.out_proj(x)
         return x
 
 
+class ElectraCrossAttention(nn.Module):
+    """Multi-head cross-attention computed with the fused SDPA kernels.
+
+    Parameters are laid out like nn.MultiheadAttention (packed in_proj_weight /
+    in_proj_bias and out_proj) so checkpoints saved with it still load.
+    """
+
+    def __init__(self, hidden_size, num_heads):
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_dim = hidden_size // num_heads
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * hidden_size, hidden_size))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * hidden_size))
+        self.out_proj = nn.Linear(hidden_size, hidden_size)
+        nn.init.xavier_uniform_(self.in_proj_weight)
+
+    def _split_heads(self, x):
+        batch_size, seq_len, _ = x.shape
+        return x.view(batch_size, seq_len, self.num_heads, self.head_dim).transpose(1, 2)
+
+    def forward(self, query, key_value, attention_mask=None):
+        batch_size, seq_len, hidden_size = query.shape
+        weight_q, weight_kv = self.in_proj_weight.split([hidden_size, 2 * hidden_size])
+        bias_q, bias_kv = self.in_proj_bias.split([hidden_size, 2 * hidden_size])
+        q = self._split_heads(F.linear(query, weight_q, bias_q))
+        k, v = (
+            self._split_heads(x)
+            for x in F.linear(key_value, weight_kv, bias_kv).chunk(2, dim=-1)
+        )
+
+        attn_mask = None
+        if attention_mask is not None:
+            # (batch, kv_len) -> (batch, 1, 1, kv_len), True where keys may be attended
+            attn_mask = attention_mask[:, None, None, :].bool()
+
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        x = x.transpose(1, 2).reshape(batch_size, seq_len, hidden_size)
+        return self.out_proj(x)
+
+
 class ElectraForSequenceClassification(ElectraPreTrainedModel):
     def __init__(self, config):
         super().__init__(config)
         self.num_labels = config.num_labels
         self.config = config
         self.electra = ElectraModel(config)
-        self.attention = MultiheadAttention(
-            self.electra.config.hidden_size, num_heads=8, batch_first=True
+        self.attention = ElectraCrossAttention(
+            self.electra.config.hidden_size, num_heads=8
         )
         self.classifier = ElectraClassificationHead(config)
 
         self.post_init()
 
+    def _init_weights(self, module):
+        super()._init_weights(module)
+        # from_pretrained skips the module's own init, so the packed projection is set here
+        if isinstance(module, ElectraCrossAttention):
+            module.in_proj_weight.data.normal_(mean=0.0, std=self.config.initializer_range)
+            module.in_proj_bias.data.zero_()
+
     def forward(
         self,
         input_ids: Optional[torch.Tensor] = None,
         attention_mask: Optional[torch.Tensor] = None,
         input_ids_cbr: Optional[torch.LongTensor] = None,
         attention_mask_cbr: Optional[torch.FloatTensor] = None,
-        token_type_ids: Optional[torch.Tensor] = None,
-        position_ids: Optional[torch.Tensor] = None,
         head_mask: Optional[torch.Tensor] = None,
-        inputs_embeds: Optional[torch.Tensor] = None,
         labels: Optional[torch.Tensor] = None,
-        output_attentions: Optional[bool] = None,
-        output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
     ):
         return_dict =return_dict if return_dict is not None else self.config.use_return_dict
 
-        discriminator_hidden_states = self.electra(
-            input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
+        batch_size = input_ids.size(0)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if attention_mask_cbr is None:
+            attention_mask_cbr = torch.ones_like(input_ids_cbr)
+        input_ids, input_ids_cbr = input_ids.long(), input_ids_cbr.long()
+        attention_mask, attention_mask_cbr = attention_mask.long(), attention_mask_cbr.long()
+
+        # Run the query and the CBR batch through a single encoder pass
+        seq_len = max(input_ids.size(1), input_ids_cbr.size(1))
+        input_ids_cat = torch.cat(
+            [
+                F.pad(input_ids, (0, seq_len - input_ids.size(1)), value=self.config.pad_token_id),
+                F.pad(input_ids_cbr, (0, seq_len - input_ids_cbr.size(1)), value=self.config.pad_token_id),
+            ],
+            dim=0,
+        )
+        attention_mask_cat = torch.cat(
+            [
+                F.pad(attention_mask, (0, seq_len - attention_mask.size(1)), value=0),
+                F.pad(attention_mask_cbr, (0, seq_len - attention_mask_cbr.size(1)), value=0),
+            ],
+            dim=0,
         )
 
-        sequence_output = discriminator_hidden_states[0]
-
-        discriminator_hidden_states_cbr = self.electra(
-            input_ids_cbr,
-            attention_mask=attention_mask_cbr,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
+        discriminator_hidden_states = self.electra(
+            input_ids_cat,
+            attention_mask=attention_mask_cat,
             head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
+            output_attentions=False,
+            output_hidden_states=False,
             return_dict=return_dict,
         )
 
-        sequence_output_cbr = discriminator_hidden_states_cbr[0]
+        sequence_output, sequence_output_cbr = discriminator_hidden_states[0].split(batch_size, dim=0)
+        attention_mask_cbr = attention_mask_cat[batch_size:]
 
-        final_output, _ = self.attention(
-            query=sequence_output, key=sequence_output_cbr, value=sequence_output_cbr
+        final_output = self.attention(
+            sequence_output, sequence_output_cbr, attention_mask=attention_mask_cbr
         )
 
+        # The loss is computed by CustomTrainer.compute_loss
         logits = self.classifier(final_output)
 
-        loss = None
-        if labels is not None:
-            if self.config.problem_type is None:
-                loss_fct = BCEWithLogitsLoss()
-                loss = loss_fct(logits, labels)
-
         if not return_dict:
-            output = (logits,) + discriminator_hidden_states[1:]
-            return ((loss,) + output) if loss is not None else output
-
-        return SequenceClassifierOutput(
-            loss=loss,
-            logits=logits,
-            hidden_states=discriminator_hidden_states.hidden_states,
-            attentions=discriminator_hidden_states.attentions,
-        )
+            return (logits,)
 
+        return SequenceClassifierOutput(logits=logits)
 
-def create_augmented_case(row, config, similar_cases: List[str]):
+
+def create_augmented_case(text: str, feature_value: str, config, similar_cases: List[str]):
     if config.feature in ["text", "explanations", "goals"]:
-        augmented_case = row["text"]
-        for similar_case in similar_cases:
-            augmented_case += f" {config.sep_token} " + similar_case
+        parts = [text, *similar_cases]
     elif config.feature in ["structure", "counter"]:
-        augmented_case = row["text"]
+        parts = [text]
         for similar_case in similar_cases:
-            augmented_case += f" {config.sep_token} {row[config.feature]} {config.sep_token} {similar_case}"
-    return augmented_case
+            parts += [feature_value, similar_case]
+    return f" {config.sep_token} ".join(parts)
 
 
 def augment_with_similar_cases(
     df: pd.DataFrame, retrievers: List[SimCSE_Retriever], config):
-    all_similar_cases = []
-    all_augmented_cases = []
-    all_similar_cases_labels = []
-
-    for _, row in tqdm(df.iterrows(), total=len(df), leave=False):
-        row_similar_cases = []
-        row_similar_cases_labels = []
-        for retriever in retrievers:
-            try:
-                similar_cases_with_labels = retriever.retrieve_similar_cases(
-                    case=row[config.feature],
-                    num_cases=config.num_cases,
-                    threshold=config.cbr_threshold,
-                )
-
-                row_similar_cases.extend(
-                    [
-                        case_label["similar_case"]
-                        for case_label in similar_cases_with_labels
-                    ]
-                )
-                row_similar_cases_labels.extend(
-                    [
-                        case_label["similar_case_label"]
-                        for case_label in similar_cases_with_labels
-                    ]
-                )
-
-            except Exception as e:
-                print(e)
+    all_similar_cases = [[] for _ in range(len(df))]
+    all_similar_cases_labels = [[] for _ in range(len(df))]
+
+    for retriever in retrievers:
+        all_similar_cases_with_labels = retriever.retrieve_similar_cases_batch(
+            cases=df[config.feature].tolist(),
+            num_cases=config.num_cases,
+            threshold=config.cbr_threshold,
+        )
 
-        augmented_case = create_augmented_case(row, config, row_similar_cases)
+        for row_similar_cases, row_similar_cases_labels, similar_cases_with_labels in zip(
+            all_similar_cases, all_similar_cases_labels, all_similar_cases_with_labels
+        ):
+            row_similar_cases.extend(
+                [case_label["similar_case"] for case_label in similar_cases_with_labels]
+            )
+            row_similar_cases_labels.extend(
+                [
+                    case_label["similar_case_label"]
+                    for case_label in similar_cases_with_labels
+                ]
+            )
 
-        all_augmented_cases.append(augmented_case)
-        all_similar_cases.append(row_similar_cases)
-        all_similar_cases_labels.append(row_similar_cases_labels)
+    all_augmented_cases = [
+        create_augmented_case(text, feature_value, config, row_similar_cases)
+        for text, feature_value, row_similar_cases in tqdm(
+            zip(df["text"].to_numpy(), df[config.feature].to_numpy(), all_similar_cases),
+            total=len(df),
+            leave=False,
+        )
+    ]
 
     df["augmented_cases"] = all_augmented_cases
     df["similar_cases"] = all_similar_cases
@@ -194,6 +234,54 @@ def augment_with_similar_cases(
     return df
 
 
+def get_cache_key(config, *extra):
+    # Everything that determines the augmented cases, plus caller specific bits
+    return hashlib.sha1(
+        "|".join(
+            str(x)
+            for x in [
+                config.data_dir,
+                config.feature,
+                config.num_cases,
+                config.cbr_threshold,
+                config.ratio_of_source_used,
+                config.retrievers,
+                config.sep_token,
+                *extra,
+            ]
+        ).encode()
+    ).hexdigest()
+
+
+def augment_with_similar_cases_cached(
+    df: pd.DataFrame, retrievers: List[SimCSE_Retriever], config, split: str):
+    key = get_cache_key(config, len(df))
+    path = os.path.join("cache", "augmented", f"aug_{split}_{key}.parquet")
+
+    if os.path.exists(path):
+        df = pd.read_parquet(path)
+        # Parquet hands list columns back as numpy arrays
+        for column in ["similar_cases", "similar_cases_labels"]:
+            df[column] = df[column].map(list)
+        return df
+
+    df = augment_with_similar_cases(df, retrievers, config)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+    return df
+
+
+def encode_labels(labels: pd.Series, label_dtype: pd.CategoricalDtype):
+    codes = labels.astype(label_dtype).cat.codes
+    if (codes < 0).any():
+        # Mirror LabelEncoder.transform instead of silently mapping to -1
+        unseen = sorted(map(str, labels[codes < 0].unique()))
+        raise ValueError(f"y contains previously unseen labels: {unseen}")
+    return codes.astype("int64")
+
+
 class CustomTrainer(Trainer):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -213,6 +301,36 @@ class CustomTrainer(Trainer):
         return (loss, outputs) if return_outputs else loss
 
 
+class CBRDataCollatorWithPadding(DataCollatorWithPadding):
+    """Pads every batch to its own longest sequence, including the CBR inputs."""
+
+    def __call__(self, features):
+        features_cbr = [
+            {
+                "input_ids": feature.pop("input_ids_cbr"),
+                "attention_mask": feature.pop("attention_mask_cbr"),
+            }
+            for feature in features
+        ]
+        batch = super().__call__(features)
+        batch_cbr = self.tokenizer.pad(
+            features_cbr,
+            padding=self.padding,
+            max_length=self.max_length,
+            pad_to_multiple_of=self.pad_to_multiple_of,
+            return_tensors=self.return_tensors,
+        )
+        batch["input_ids_cbr"] = batch_cbr["input_ids"]
+        batch["attention_mask_cbr"] = batch_cbr["attention_mask"]
+
+        # Narrow dtypes to cut host-to-device traffic, forward() widens them again
+        for name in ["input_ids", "input_ids_cbr"]:
+            batch[name] = batch[name].to(torch.int32)
+        for name in ["attention_mask", "attention_mask_cbr"]:
+            batch[name] = batch[name].bool()
+        return batch
+
+
 def save_results(
     config, label_encoder, predictions, test_df
 ):
@@ -232,15 +350,55 @@ def save_results(
     outputs_dict["similar_cases"] = test_df["similar_cases"].tolist()
     outputs_dict["similar_cases_labels"] = test_df["similar_cases_labels"].tolist()
 
+    os.makedirs(config.predictions_dir, exist_ok=True)
     file_name = os.path.join(config.predictions_dir, f"outputs_dict__{now}.joblib")
 
-    joblib.dump(outputs_dict, "res2.joblib")
+    joblib.dump(outputs_dict, file_name, compress=3, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def do_train_process(config=None):
-    with wandb.init(config=config):
+    # Under torchrun only the first process reports to wandb
+    is_main_process = int(os.environ.get("RANK", "0")) == 0
+    with wandb.init(
+        config=config, project="CBR", mode=None if is_main_process else "disabled"
+    ):
         config = wandb.config
 
+        # Step intervals were tuned at batch size 8, keep them at the same number of examples
+        log_eval_save_steps = max(1, 200 * 8 // config.batch_size)
+
+        use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        use_fp16 = torch.cuda.is_available() and not use_bf16
+
+        training_args = TrainingArguments(
+            do_eval=True,
+            do_train=True,
+            output_dir=f"models/cbr_electra_logical_fallacy_classification_{config.data_dir.replace('/', '_')}",
+            save_total_limit=2,
+            load_best_model_at_end=True,
+            learning_rate=config.learning_rate,
+            per_device_train_batch_size=config.batch_size,
+            per_device_eval_batch_size=config.batch_size,
+            num_train_epochs=config.num_epochs,
+            weight_decay=config.weight_decay,
+            gradient_checkpointing=config.gradient_checkpointing,
+            save_strategy="steps",
+            logging_strategy="steps",
+            evaluation_strategy="steps",
+            logging_steps=log_eval_save_steps,
+            eval_steps=log_eval_save_steps,
+            save_steps=log_eval_save_steps,
+            ddp_find_unused_parameters=False,
+            dataloader_pin_memory=True,
+            dataloader_num_workers=4,
+            bf16=use_bf16,
+            fp16=use_fp16,
+            # Default mode: "reduce-overhead" would record a CUDA graph per padded length.
+            # No torch_compile_mode either, TrainingArguments turns compilation on when one is set.
+            torch_compile=config.torch_compile and torch.cuda.is_available(),
+            report_to="wandb",
+        )
+
         train_df = pd.read_csv(os.path.join(config.data_dir, "train.csv"))
         dev_df = pd.read_csv(os.path.join(config.data_dir, "dev.csv"))
         test_df = pd.read_csv(os.path.join(config.data_dir, "test.csv"))
@@ -260,17 +418,24 @@ def do_train_process(config=None):
                 print("retreiver not found")
                 exit()
 
-        dfs_to_process = [train_df, dev_df, test_df]
-        for df in dfs_to_process:
-            df = augment_with_similar_cases(df, retrievers_to_use, config)
+        splits = ["train", "dev", "test"]
+        with training_args.main_process_first(local=False, desc="augmentation"):
+            all_df = augment_with_similar_cases_cached(
+                pd.concat([train_df, dev_df, test_df], keys=splits),
+                retrievers_to_use,
+                config,
+                "all",
+            )
+        train_df, dev_df, test_df = [all_df.loc[split] for split in splits]
 
 
         label_encoder = LabelEncoder()
         label_encoder.fit(train_df["label"])
 
-        train_df["label"] = label_encoder.transform(train_df["label"])
-        dev_df["label"] = label_encoder.transform(dev_df["label"])
-        test_df["label"] = label_encoder.transform(test_df["label"])
+        label_dtype = pd.CategoricalDtype(categories=list(label_encoder.classes_))
+        train_df["label"] = encode_labels(train_df["label"], label_dtype)
+        dev_df["label"] = encode_labels(dev_df["label"], label_dtype)
+        test_df["label"] = encode_labels(test_df["label"], label_dtype)
 
         dataset = DatasetDict(
             {
@@ -280,23 +445,31 @@ def do_train_process(config=None):
             }
         )
 
+        # Older transformers releases only ship an eager Electra self-attention
+        attn_kwargs = (
+            {"attn_implementation": "sdpa"}
+            if getattr(ElectraForSequenceClassification, "_supports_sdpa", False)
+            else {}
+        )
+
         if config.eval_only:
-            tokenizer = ElectraTokenizer.from_pretrained(config.model_dir)
-            model = ElectraForSequenceClassification.from_pretrained(config.model_dir)
+            tokenizer = ElectraTokenizerFast.from_pretrained(config.model_dir)
+            model = ElectraForSequenceClassification.from_pretrained(
+                config.model_dir, **attn_kwargs
+            )
         else:
-            tokenizer = ElectraTokenizer.from_pretrained(checkpoint_for_adapter)
+            tokenizer = ElectraTokenizerFast.from_pretrained(checkpoint_for_adapter)
             model = ElectraForSequenceClassification.from_pretrained(
                 checkpoint_for_adapter,
                 num_labels=len(list(label_encoder.classes_)),
                 classifier_dropout=config.classifier_dropout,
                 ignore_mismatched_sizes=True,
+                **attn_kwargs,
             )
 
         def process(batch):
-            inputs = tokenizer(batch["text"], truncation=True, padding="max_length")
-            inputs_cbr = tokenizer(
-                batch["augmented_cases"], truncation=True, padding="max_length"
-            )
+            inputs = tokenizer(batch["text"], truncation=True)
+            inputs_cbr = tokenizer(batch["augmented_cases"], truncation=True)
             return {
                 "input_ids": inputs["input_ids"],
                 "attention_mask": inputs["attention_mask"],
@@ -305,32 +478,39 @@ def do_train_process(config=None):
                 "labels": batch["label"],
             }
 
-        tokenized_dataset = dataset.map(
-            process, batched=True, remove_columns=dataset["train"].column_names
+        tokenized_dir = os.path.join(
+            "cache",
+            "tokenized",
+            f"tok_{config.feature}_{config.num_cases}_{config.cbr_threshold}_"
+            f"{get_cache_key(config, tokenizer.name_or_path)}",
         )
+        # Rank 0 builds the cache first, the other ranks then load it
+        with training_args.main_process_first(local=False, desc="tokenization"):
+            if os.path.exists(tokenized_dir):
+                tokenized_dataset = load_from_disk(tokenized_dir)
+            else:
+                tokenized_dataset = dataset.map(
+                    process,
+                    batched=True,
+                    batch_size=1000,
+                    num_proc=max(1, (os.cpu_count() or 1) // 2),
+                    remove_columns=dataset["train"].column_names,
+                    load_from_cache_file=True,
+                )
+                # Write next to the target and move it in place so a partial save is never reused
+                tmp_dir = f"{tokenized_dir}.tmp-{os.getpid()}"
+                tokenized_dataset.save_to_disk(tmp_dir)
+                try:
+                    os.replace(tmp_dir, tokenized_dir)
+                except OSError:
+                    # A concurrent run (e.g. another sweep agent) saved the same cache first
+                    if not os.path.isdir(tokenized_dir):
+                        raise
+                    shutil.rmtree(tmp_dir)
+                    tokenized_dataset = load_from_disk(tokenized_dir)
 
         print("Model loaded!")
 
-        training_args = TrainingArguments(
-            do_eval=True,
-            do_train=True,
-            output_dir=f"models/cbr_electra_logical_fallacy_classification_{config.data_dir.replace('/', '_')}",
-            save_total_limit=2,
-            load_best_model_at_end=True,
-            learning_rate=config.learning_rate,
-            per_device_train_batch_size=config.batch_size,
-            per_device_eval_batch_size=config.batch_size,
-            num_train_epochs=config.num_epochs,
-            weight_decay=config.weight_decay,
-            save_strategy="steps",
-            logging_strategy="steps",
-            evaluation_strategy="steps",
-            logging_steps=200,
-            eval_steps=200,
-            save_steps=200,
-            report_to="wandb",
-        )
-
         def compute_metrics(pred):
             labels = pred.label_ids
             preds = pred.predictions.argmax(-1)
@@ -346,6 +526,7 @@ def do_train_process(config=None):
             train_dataset=tokenized_dataset["train"],
             eval_dataset=tokenized_dataset["eval"],
             tokenizer=tokenizer,
+            data_collator=CBRDataCollatorWithPadding(tokenizer, pad_to_multiple_of=8),
             compute_metrics=compute_metrics,
         )
 
@@ -359,9 +540,10 @@ def do_train_process(config=None):
 
         predictions = trainer.predict(tokenized_dataset["test"])
 
-        save_results(
-            config, label_encoder, predictions, test_df
-        )
+        if trainer.is_world_process_zero():
+            save_results(
+                config, label_encoder, predictions, test_df
+            )
 
 
 if __name__ == "__main__":
@@ -432,16 +614,26 @@ if __name__ == "__main__":
         "cbr_threshold": {"values": [-1e7, 0.5]},
         "data_dir": {"values": [args.data_dir]},
         "predictions_dir": {"values": [args.predictions_dir]},
-        "batch_size": {"values": [8]},
+        "batch_size": {"values": [32]},
+        "gradient_checkpointing": {"values": [True]},
+        "torch_compile": {"values": [True]},
         "learning_rate": {"values": [8.448e-05]},
         "num_epochs": {"values": [6]},
         "classifier_dropout": {"values": [0.1]},
         "weight_decay": {"values": [0.05]},
     }
 
-    sweep_config["parameters"] = parameters_dict
-    sweep_id = wandb.sweep(
-        sweep_config,
-        project="CBR",
-    )
-    wandb.agent(sweep_id, do_train_process, count=1)
+    # Multi-GPU runs are launched with `torchrun --nproc_per_node=$NGPU electra.py ...`,
+    # which makes the Trainer use DistributedDataParallel. A sweep agent per process
+    # would register separate runs, so the first value of each parameter is used.
+    if int(os.environ.get("WORLD_SIZE", "1")) > 1:
+        do_train_process(
+            {name: values["values"][0] for name, values in parameters_dict.items()}
+        )
+    else:
+        sweep_config["parameters"] = parameters_dict
+        sweep_id = wandb.sweep(
+            sweep_config,
+            project="CBR",
+        )
+        wandb.agent(sweep_id, do_train_process, count=1)
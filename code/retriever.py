@@ -1,8 +1,12 @@
 import os
+import heapq
+import hashlib
 import joblib
 import numpy as np
 import pandas as pd
-from transformers import AutoModel
+import torch
+from typing import List
+from transformers import AutoModel, AutoTokenizer
 
 class SimCSE_Retriever():
     def __init__(self, config) -> None:
@@ -25,9 +29,11 @@ class SimCSE_Retriever():
     def retrieve_similar_cases(
         self, case: str, num_cases: int = 1, threshold: float = -np.inf
     ):
-        sentences_and_similarities = self.similarities_dict[case.strip()].items()
-        sentences_and_similarities_sorted = sorted(
-            sentences_and_similarities, key=lambda x: x[1][0], reverse=True
+        # The top hit is skipped below, so fetch one extra candidate
+        sentences_and_similarities_sorted = heapq.nlargest(
+            num_cases + 1,
+            self.similarities_dict[case.strip()].items(),
+            key=lambda x: x[1][0],
         )
 
         return [
@@ -36,10 +42,57 @@ class SimCSE_Retriever():
             if x[1][0] > threshold
         ]
 
+    def retrieve_similar_cases_batch(
+        self, cases: List[str], num_cases: int = 1, threshold: float = -np.inf
+    ):
+        all_similar_cases = []
+        for case in cases:
+            # A case that cannot be looked up (e.g. an empty feature) gets no matches
+            try:
+                similar_cases = self.retrieve_similar_cases(
+                    case=case, num_cases=num_cases, threshold=threshold
+                )
+            except Exception as e:
+                print(e)
+                similar_cases = []
+            all_similar_cases.append(similar_cases)
+        return all_similar_cases
+
 def get_embeddings_simcse(model, text: str):
     return model.encode(text)
 
 
+@torch.no_grad()
+def encode_simcse(model, tokenizer, sentences: List[str], batch_size: int = 64, max_length: int = 128):
+    # Supervised SimCSE checkpoints use the [CLS] pooler output as the sentence embedding
+    device = next(model.parameters()).device
+    embeddings = []
+    for start in range(0, len(sentences), batch_size):
+        inputs = tokenizer(
+            sentences[start : start + batch_size],
+            padding=True,
+            truncation=True,
+            max_length=max_length,
+            return_tensors="pt",
+        ).to(device)
+        embeddings.append(model(**inputs).pooler_output)
+    return torch.nn.functional.normalize(torch.cat(embeddings), dim=-1)
+
+
+def get_corpus_embeddings_simcse(model, tokenizer, model_name: str, sentences: List[str]):
+    corpus_hash = hashlib.sha1("\n".join(sentences).encode()).hexdigest()
+    cache_path = os.path.join(
+        "..", "cache", f"simcse_embeddings_{model_name.replace('/', '_')}_{corpus_hash}.pt"
+    )
+    if os.path.exists(cache_path):
+        return torch.load(cache_path)
+
+    embeddings = encode_simcse(model, tokenizer, sentences).half().cpu()
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    torch.save(embeddings, cache_path)
+    return embeddings
+
+
 def generate_the_simcse_similarities(
     source_file: str,
     target_file_template: str,
@@ -49,12 +102,15 @@ def generate_the_simcse_similarities(
 ):
 
 
-    model = AutoModel.from_pretrained("princeton-nlp/sup-simcse-roberta-large")
+    model_name = "princeton-nlp/sup-simcse-roberta-large"
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name)
+    model.to("cuda" if torch.cuda.is_available() else "cpu").eval()
 
     source_file_df = (
         pd.read_csv(source_file)
         .groupby("label")
-        .apply(lambda x: x.sample(frac=ratio_of_source_used))
+        .apply(lambda x: x.sample(frac=ratio_of_source_used, random_state=0))
         .reset_index(drop=True)
     )
 
@@ -62,6 +118,13 @@ def generate_the_simcse_similarities(
     train_labels = source_file_df["label"].tolist()
 
     train_sentences = [x.strip() for x in train_sentences]
+    # sample() shuffles the rows, sort so the embedding cache key does not depend on order
+    train_sentences, train_labels = (
+        list(x) for x in zip(*sorted(zip(train_sentences, train_labels)))
+    )
+    train_embeddings = get_corpus_embeddings_simcse(
+        model, tokenizer, model_name, train_sentences
+    ).float()
 
     for split in ["train", "dev", "test"]:
         target_file = target_file_template.replace("split", split)
@@ -69,7 +132,9 @@ def generate_the_simcse_similarities(
         all_sentences = pd.read_csv(target_file)[feature].tolist()
         all_sentences = [x.strip() for x in all_sentences]
 
-        similarities = model.similarity(all_sentences, train_sentences)
+        # Embeddings are unit-normalised, so the dot product is the cosine similarity
+        query_embeddings = encode_simcse(model, tokenizer, all_sentences).float().cpu()
+        similarities = (query_embeddings @ train_embeddings.T).numpy()
         similarities_dict = dict()
         for sentence, row in zip(all_sentences, similarities):
             similarities_dict[sentence] = dict(